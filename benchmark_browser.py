@@ -0,0 +1,233 @@
+"""
+Benchmarks for the browser side of the scraper.
+
+pages: compare page load time and browser memory use between the default and lean browser profiles.
+Starts each profile against the live site, navigates to the next few days with nav_to_date, and reports
+the time to start the browser, load the facility page, and navigate to and parse a day, along with the
+resident memory of the browser's whole process tree afterwards. The profiles take turns going first.
+
+startup: compare cold start time of the daemon, from process start to the first day written to the database,
+with and without pre-warming the browser. Each run happens in a fresh process, against the live site.
+The first day is due right away, so pre-warming only overlaps the browser start with setting up the database,
+and the two should come out close.
+
+Usage: python benchmark_browser.py {pages,startup} [--repeats N] [--days N] [--debug]
+"""
+
+# taken first, so that startup timings include importing the scraper
+import time
+_process_start = time.time()
+
+import argparse
+from collections import defaultdict
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import schedule_scraper as scsc
+import scraper_daemon as sd
+
+# seconds to wait between requests to the live site, outside of the timings
+request_pause = 3.
+
+def process_tree_rss_kb(pid):
+    """
+    Total resident memory of a process and all of its descendants, in kB, or None if it can't be determined.
+
+    Relies on /proc, so it only works on Linux.
+    """
+
+    children = defaultdict(list)
+    rss_kb = {}
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/status' % entry) as fd:
+                for line in fd:
+                    if line.startswith('PPid:'):
+                        children[int(line.split()[1])].append(int(entry))
+                    elif line.startswith('VmRSS:'):
+                        rss_kb[int(entry)] = int(line.split()[1])
+        except IOError:
+            # process exited while looking
+            continue
+
+    if pid not in rss_kb:
+        return None
+
+    total = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        total += rss_kb.get(p, 0)
+        pids.extend(children[p])
+
+    return total
+
+
+def browser_rss_kb():
+    """
+    Resident memory of the browser, in kB, or None if it can't be determined.
+
+    Counts the process started by selenium and everything under it. For PhantomJS that is the browser itself.
+    For Chrome it is chromedriver, the browser and its renderers, so chromedriver's few MB are included.
+    """
+
+    try:
+        pid = scsc.browser.service.process.pid
+    except AttributeError:
+        return None
+
+    return process_tree_rss_kb(pid)
+
+
+def run_profile(lean, days, debug_mode=False):
+    """
+    Time one browser session with the given profile against the live site.
+
+    Returns
+    -------
+    startup_sec : float
+        Time taken to start the browser.
+    first_load_sec : float
+        Time taken to load the facility page.
+    day_sec : float
+        Average time taken to navigate to a day with nav_to_date and parse its events.
+    rss_kb : int or None
+        Resident memory of the browser after all page loads.
+    """
+
+    t0 = time.time()
+    scsc.init_browser(debug_mode, lean)
+    startup_sec = time.time() - t0
+
+    try:
+        t0 = time.time()
+        scsc.nav_to_url(scsc.page_url_stub + scsc.pac_pool_id)
+        first_load_sec = time.time() - t0
+
+        times = []
+        for delta in range(1, days + 1):
+            date = datetime.date.today() + datetime.timedelta(delta)
+            time.sleep(request_pause)
+
+            t0 = time.time()
+            scsc.nav_to_date(date.year, date.month, date.day)
+            scsc.get_events()
+            times.append(time.time() - t0)
+
+        rss_kb = browser_rss_kb()
+    finally:
+        scsc.quit_browser()
+
+    return startup_sec, first_load_sec, sum(times) / len(times), rss_kb
+
+
+class _FirstDayWritten(Exception):
+    """
+    Raised to stop the daemon once it has written its first day.
+    """
+
+
+def time_cold_start(prewarm, debug_mode=False):
+    """
+    Run the daemon on an empty database, and time how long it takes to write its first day.
+
+    Meant to run in a fresh process, so that imports count towards the startup time.
+
+    Returns
+    -------
+    elapsed_sec : float
+        Time between process start and the first call to update_day finishing.
+    """
+
+    sd.debug_mode = debug_mode
+    tmp_dir = tempfile.mkdtemp()
+
+    update_day = scsc.update_day
+
+    def timed_update_day(*args, **kwargs):
+        update_day(*args, **kwargs)
+        raise _FirstDayWritten()
+
+    scsc.update_day = timed_update_day
+    try:
+        sd.maintain_schedules(os.path.join(tmp_dir, 'benchmark.db'), [{'start': 0, 'end': 0, 'period': 60}],
+                              prewarm=prewarm)
+    except _FirstDayWritten:
+        return time.time() - _process_start
+    finally:
+        scsc.update_day = update_day
+        scsc.quit_browser()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def run_pages(args):
+    # imported up front, so that neither profile's startup time includes it
+    from selenium import webdriver
+
+    profiles = [('default', False), ('lean', True)]
+    results = defaultdict(list)
+
+    for i in range(args.repeats):
+        # take turns going first, so neither profile always gets a cold system
+        for name, lean in (profiles if i % 2 == 0 else profiles[::-1]):
+            results[name].append(run_profile(lean, args.days, args.debug))
+
+    mean = lambda values: sum(values) / len(values)
+
+    print '%-8s %12s %14s %12s %10s' % ('profile', 'startup (s)', 'first load (s)', 'per day (s)', 'RSS (MB)')
+    for name, _ in profiles:
+        startup_sec, first_load_sec, day_sec, rss_kb = zip(*results[name])
+        rss_kb = [r for r in rss_kb if r is not None]
+        rss_str = '%.1f' % (mean(rss_kb) / 1024.) if rss_kb else 'n/a'
+        print '%-8s %12.2f %14.2f %12.3f %10s' % (
+            name, mean(startup_sec), mean(first_load_sec), mean(day_sec), rss_str
+        )
+
+
+def run_startup(args):
+    print '%-12s %14s %14s %14s' % ('mode', 'mean (s)', 'min (s)', 'max (s)')
+    for name, flags in [('prewarm', []), ('no-prewarm', ['--no-prewarm'])]:
+        times = []
+        for _ in range(args.repeats):
+            cmd = [sys.executable, __file__, 'startup-child'] + flags + (['--debug'] if args.debug else [])
+            times.append(float(subprocess.check_output(cmd).strip().splitlines()[-1]))
+        print '%-12s %14.2f %14.2f %14.2f' % (name, sum(times) / len(times), min(times), max(times))
+
+
+def run_startup_child(args):
+    print '%.3f' % time_cold_start(args.prewarm, args.debug)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('pages', help='page load time and memory on the live site, default vs. lean profile')
+    p.add_argument('--repeats', type=int, default=3, help='number of sessions per profile')
+    p.add_argument('--days', type=int, default=5, help='number of days to navigate to per session')
+    p.add_argument('--debug', action='store_true', help='use Chrome instead of PhantomJS')
+    p.set_defaults(func=run_pages)
+
+    p = subparsers.add_parser('startup', help='time to first day written, with and without pre-warming')
+    p.add_argument('--repeats', type=int, default=3)
+    p.add_argument('--debug', action='store_true', help='use Chrome instead of PhantomJS')
+    p.set_defaults(func=run_startup)
+
+    # single timing run, started by `startup` in a fresh process
+    p = subparsers.add_parser('startup-child')
+    p.add_argument('--no-prewarm', dest='prewarm', action='store_false')
+    p.add_argument('--debug', action='store_true')
+    p.set_defaults(func=run_startup_child)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
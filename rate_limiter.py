@@ -0,0 +1,203 @@
+"""
+Rate limiting for requests to the schedule server.
+
+Every fetch goes through a RateLimiter, which paces requests with a token bucket, caps the number of requests in
+flight, and acts as a circuit breaker: when requests start failing or slowing down, it stops letting requests
+through for a while, then lets a single probe request through to check whether the server has recovered.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+# circuit breaker states
+CLOSED = 'closed'  # requests flow normally
+OPEN = 'open'  # requests are held back until the cooldown is over
+HALF_OPEN = 'half_open'  # one probe request is allowed through to test the server
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter with a concurrency cap and a circuit breaker.
+
+    Safe to share between threads.
+
+    Parameters
+    ----------
+    rate : float
+        Sustained number of requests allowed per second.
+    burst : int
+        Number of requests that may be made back to back after an idle period.
+    max_concurrency : int
+        Maximum number of requests in flight at once.
+    latency_threshold : float
+        Trip the circuit when the average latency of recent requests exceeds this many seconds.
+    error_threshold : float
+        Trip the circuit when the fraction of recent requests that failed reaches this value.
+    window : int
+        Number of recent requests to consider when checking latency and error rate.
+    min_samples : int
+        Minimum number of recent requests needed before the circuit can trip.
+    cooldown : float
+        Seconds to hold requests back after the circuit trips.
+        Doubles every time a probe fails, up to max_cooldown.
+    max_cooldown : float
+        Longest cooldown, in seconds.
+    clock : function
+        Returns the current time in seconds. Replaceable for testing.
+    """
+
+    def __init__(self, rate=0.5, burst=1, max_concurrency=1, latency_threshold=15., error_threshold=0.5,
+                 window=10, min_samples=3, cooldown=60., max_cooldown=15*60., clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.latency_threshold = latency_threshold
+        self.error_threshold = error_threshold
+        self.min_samples = min_samples
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+
+        self.state = CLOSED
+        self.cooldown = cooldown
+        self.open_until = None
+
+        self._tokens = float(burst)
+        self._last_refill = clock()
+        self._active = 0
+        self._probing = False
+        self._history = deque(maxlen=window)  # (latency, failed) of recent requests
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a request may be made.
+
+        Every call must be matched by a call to release(), passing on the value returned here.
+
+        Returns
+        -------
+        is_probe : bool
+            True if the request is the probe testing whether the server has recovered.
+        """
+
+        with self._cond:
+            while True:
+                now = self.clock()
+
+                if self.state == OPEN:
+                    if now < self.open_until:
+                        self._cond.wait(self.open_until - now)
+                        continue
+                    self.state = HALF_OPEN
+                    print 'Rate limiter: cooldown over, probing server.'
+
+                if self.state == HALF_OPEN and self._probing:
+                    self._cond.wait(1.)
+                    continue
+
+                if self._active >= self.max_concurrency:
+                    self._cond.wait(1.)
+                    continue
+
+                self._refill(now)
+                if self._tokens < 1.:
+                    self._cond.wait((1. - self._tokens) / self.rate)
+                    continue
+
+                self._tokens -= 1.
+                self._active += 1
+                if self.state == HALF_OPEN:
+                    self._probing = True
+                    return True
+                return False
+
+    def release(self, latency, failed=False, is_probe=False):
+        """
+        Record the outcome of a request made after acquire(), and free up its slot.
+
+        Only the probe decides whether an open circuit closes again. Requests that were already in flight when
+        the circuit opened don't count towards it.
+
+        Parameters
+        ----------
+        latency : float
+            Time taken by the request, in seconds.
+        failed : bool
+            Whether the request failed.
+        is_probe : bool
+            Value returned by the matching call to acquire().
+        """
+
+        with self._cond:
+            self._active -= 1
+
+            if is_probe:
+                self._probing = False
+                if failed or latency > self.latency_threshold:
+                    self.cooldown = min(2 * self.cooldown, self.max_cooldown)
+                    self._trip()
+                else:
+                    print 'Rate limiter: server recovered.'
+                    self.state = CLOSED
+                    self.cooldown = self.base_cooldown
+                    self._history.clear()
+            elif self.state == CLOSED:
+                self._history.append((latency, failed))
+                if self._should_trip():
+                    self._trip()
+
+            self._cond.notify_all()
+
+    @contextmanager
+    def request(self):
+        """
+        Context manager wrapping a single request.
+
+        Waits for permission on entry, and records the latency on exit.
+        An exception raised inside the block counts as a failed request, and is passed on.
+        The slot is freed however the block exits.
+        """
+
+        is_probe = self.acquire()
+        start = self.clock()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.release(self.clock() - start, failed, is_probe)
+
+    def _refill(self, now):
+        """
+        Add the tokens earned since the last refill.
+        """
+
+        self._tokens = min(float(self.burst), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _should_trip(self):
+        """
+        Check whether recent requests have been slow or failing enough to open the circuit.
+        """
+
+        if len(self._history) < self.min_samples:
+            return False
+
+        n = float(len(self._history))
+        error_rate = sum(1 for _, failed in self._history if failed) / n
+        mean_latency = sum(latency for latency, _ in self._history) / n
+
+        return error_rate >= self.error_threshold or mean_latency > self.latency_threshold
+
+    def _trip(self):
+        """
+        Open the circuit, holding requests back for the current cooldown.
+        """
+
+        self.state = OPEN
+        self.open_until = self.clock() + self.cooldown
+        self._history.clear()
+        print 'Rate limiter: server slow or failing, backing off for %d seconds.' % self.cooldown
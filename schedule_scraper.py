@@ -1,20 +1,190 @@
 import codecs
+import csv
 import datetime
+from HTMLParser import HTMLParser
+import json
 import os
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
 import time
 import urllib
 import urlparse
 
-from selenium import webdriver
-from selenium.common.exceptions import StaleElementReferenceException
+import rate_limiter
+
+# Selenium is only imported once a browser is actually started (see init_browser), so that
+# database-only tools and tests don't pay for loading the browser stack.
+browser = None
+
+# background thread started by prewarm_browser, and any exception it raised
+_prewarm_thread = None
+_prewarm_error = None
+
+# disk cache directory of the current lean browser session
+_cache_dir = None
+
+def init_browser(debug_mode=False, lean=False):
+    """
+    Start the browser.
+
+    Parameters
+    ----------
+    debug_mode : bool
+        If True, start a visible Chrome window. Otherwise, start a headless PhantomJS.
+    lean : bool
+        If True, use a profile that skips resources the scraper doesn't need (see lean_blocked_urls),
+        doesn't render images, uses a small viewport, and keeps a disk cache for the session.
+        With PhantomJS, this skips the site's stylesheets and images.
+        With Chrome, only images are skipped: the site serves its stylesheets from the same DXR.axd handler as
+        its scripts, and Chrome can't block them by type through selenium.
+    """
+
+    global browser, _cache_dir
+    from selenium import webdriver
+
+    if not lean:
+        if debug_mode:
+            browser = webdriver.Chrome()
+        else:
+            browser = webdriver.PhantomJS()
+        return
+
+    _cache_dir = tempfile.mkdtemp(prefix='scsc_cache_')
 
-def init_browser(debug_mode=False):
-    global browser
     if debug_mode:
-        browser = webdriver.Chrome()
+        options = webdriver.ChromeOptions()
+        options.add_argument('--window-size=%d,%d' % lean_viewport)
+        options.add_argument('--disk-cache-dir=%s' % _cache_dir)
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        browser = webdriver.Chrome(chrome_options=options)
+
+        # URL blocking goes through the DevTools protocol, which older versions of selenium can't reach.
+        # This only catches resources with recognizable URLs; blocking by resource type would need the
+        # Fetch domain, whose paused requests have to be answered from an event listener selenium doesn't offer.
+        if hasattr(browser, 'execute_cdp_cmd'):
+            browser.execute_cdp_cmd('Network.enable', {})
+            browser.execute_cdp_cmd('Network.setBlockedURLs', {'urls': lean_blocked_urls})
     else:
-        browser = webdriver.PhantomJS()
+        browser = webdriver.PhantomJS(service_args=[
+            '--load-images=false',
+            '--disk-cache=true',
+            '--disk-cache-path=%s' % _cache_dir,
+        ])
+        browser.set_window_size(*lean_viewport)
+
+        # install a request filter on the page object, which lives in PhantomJS itself rather than the page
+        browser.command_executor._commands['executePhantomScript'] = ('POST', '/session/$sessionId/phantom/execute')
+        browser.execute('executePhantomScript', {
+            'script': _phantom_filter_js % json.dumps([wildcard_to_regex(w) for w in lean_blocked_urls]),
+            'args': []
+        })
+
+
+# Request filter for PhantomJS.
+# DevExpress serves stylesheets from the same DXR.axd handler as its scripts, so those are told apart by the
+# Accept header instead of the URL.
+_phantom_filter_js = '''
+var blocked = %s.map(function(pattern) { return new RegExp(pattern, 'i'); });
+
+this.onResourceRequested = function(requestData, networkRequest) {
+    var isStylesheet = requestData.headers.some(function(header) {
+        return header.name.toLowerCase() === 'accept' && header.value.indexOf('text/css') === 0;
+    });
+    var isBlocked = blocked.some(function(regex) { return regex.test(requestData.url); });
+
+    if (isStylesheet || isBlocked) {
+        networkRequest.abort();
+    }
+};
+'''
+
+
+def wildcard_to_regex(pattern):
+    """
+    Convert a URL pattern, where `*` matches any run of characters, into a regular expression.
+
+    The result only uses syntax common to Python and JavaScript.
+
+    Parameters
+    ----------
+    pattern : str
+        URL pattern, such as '*.css*'.
+
+    Returns
+    -------
+    regex : str
+    """
+
+    return '^' + '.*'.join(re.escape(part) for part in pattern.split('*')) + '$'
+
+
+def quit_browser():
+    """
+    Close the browser, and delete the disk cache of a lean browser session.
+    """
+
+    global browser, _cache_dir
+
+    if browser is not None:
+        browser.quit()
+        browser = None
+
+    if _cache_dir is not None:
+        shutil.rmtree(_cache_dir, ignore_errors=True)
+        _cache_dir = None
+
+
+def prewarm_browser(url, debug_mode=False, lean=False):
+    """
+    Start the browser and load a page in a background thread.
+
+    Call wait_for_browser() before using the browser, to make sure it is ready.
+
+    Parameters
+    ----------
+    url : str
+        URL of page to load once the browser has started.
+    debug_mode, lean : bool
+        Passed on to init_browser.
+    """
+
+    global _prewarm_thread, _prewarm_error
+
+    def start():
+        global _prewarm_error
+        try:
+            init_browser(debug_mode, lean)
+            nav_to_url(url)
+        except Exception as e:
+            _prewarm_error = e
+
+    _prewarm_error = None
+    _prewarm_thread = threading.Thread(target=start, name='prewarm_browser')
+    _prewarm_thread.daemon = True
+    _prewarm_thread.start()
+
+
+def wait_for_browser():
+    """
+    Block until a browser started by prewarm_browser is ready.
+
+    Returns immediately if no browser is being pre-warmed.
+    Re-raises any exception that occurred while starting the browser.
+    """
+
+    global _prewarm_thread, _prewarm_error
+
+    if _prewarm_thread is not None:
+        _prewarm_thread.join()
+        _prewarm_thread = None
+
+    if _prewarm_error is not None:
+        e, _prewarm_error = _prewarm_error, None
+        raise e
 
 def main():
     # open the page
@@ -24,7 +194,7 @@ def main():
     nav_to_date(2018, 6, 15)
     print get_date()
 
-    browser.quit()
+    quit_browser()
 
 
 # options
@@ -34,6 +204,32 @@ default_timeout = 30.
 page_url_stub = 'https://nike.uwaterloo.ca/FacilityScheduling/FacilitySchedule.aspx?FacilityId='
 pac_pool_id = '5d72208a-069d-4931-aaa6-9527346efc6f'
 
+# Resources skipped by the lean browser profile, as URL patterns where `*` matches anything.
+# Only stylesheets, images and fonts are skipped. Scripts all still load, since nav_to_date depends on the
+# page's own scripts behaving as usual.
+lean_blocked_urls = [
+    '*.css', '*.css?*',
+    '*.png', '*.png?*', '*.jpg', '*.jpg?*', '*.gif', '*.gif?*', '*.ico', '*.ico?*', '*.svg', '*.svg?*',
+    '*.woff', '*.woff?*', '*.woff2', '*.woff2?*', '*.ttf', '*.ttf?*', '*.eot', '*.eot?*',
+    '*://fonts.googleapis.com/*',
+]
+
+# Activity categories used in day summaries, as (category, regular expression) pairs.
+# An event gets the first category whose expression matches its description (ignoring case), or 'other'.
+event_categories = [
+    ('varsity', r'\bvarsity\b'),
+    ('rec_swim', r'\b(rec|lane|open|recreational) swim'),
+    ('club', r'\bclub\b'),
+    ('lessons', r'\bLTS\b|learn to swim|\blessons?\b|\bclasses\b'),
+]
+
+# window size (width, height) of the lean browser profile
+lean_viewport = (800, 600)
+
+# Paces every request to the server (nav_to_url, nav_to_date), backing off when it is slow or failing.
+# Replace with a differently configured RateLimiter to change the pacing.
+limiter = rate_limiter.RateLimiter(rate=0.5, burst=2, max_concurrency=1, latency_threshold=default_timeout / 2)
+
 # other initialization
 month_num2str = {
     1: 'January', 2: 'February', 3: 'March', 4: 'April', 5: 'May', 6: 'June',
@@ -81,6 +277,8 @@ def wait_for_page_load(timeout_sec, fun, *args, **kwargs):
         Arguments to pass to fun.
     """
 
+    from selenium.common.exceptions import StaleElementReferenceException
+
     # watch date element -- it should expire when page load finishes, resulting in an exception
     elem_day = browser.find_element_by_class_name('dxscDateHeader_Metropolis')
 
@@ -139,11 +337,12 @@ def nav_to_date(year, month, day, timeout=default_timeout):
     ASPx.SchedulerGotoDate(cal, 'ctl00_contentMain_schedulerMain_viewNavigatorBlock_ctl00');
     ''' % (year, month - 1, day, 0)  # for some reason, calendar objects represent months starting with 0: January
 
-    wait_for_page_load(timeout, browser.execute_script, js_source)
+    with limiter.request():
+        wait_for_page_load(timeout, browser.execute_script, js_source)
 
-    # check results
-    loaded_ymd = get_date()
-    assert (year, month, day) == loaded_ymd, 'Failed to load the requested date.'
+        # check results
+        loaded_ymd = get_date()
+        assert (year, month, day) == loaded_ymd, 'Failed to load the requested date.'
 
 
 def get_events():
@@ -160,9 +359,7 @@ def get_events():
     """
 
     # get the element containing all elements_in_schedule
-    event_container = browser.find_element_by_id(
-        'ctl00_contentMain_schedulerMain_containerBlock_verticalContainerappointmentLayer'
-    )
+    event_container = browser.find_element_by_id(event_container_id)
 
     # get all child objects
     elements_in_schedule = event_container.find_elements_by_xpath('.//*')
@@ -206,17 +403,156 @@ def get_events():
     return parsed_events
 
 
+# id of the element holding the events scraped by get_events and parse_events
+# (the scheduler keeps all-day appointments in a separate, horizontal layer)
+event_container_id = 'ctl00_contentMain_schedulerMain_containerBlock_verticalContainerappointmentLayer'
+
+class _EventPageParser(HTMLParser):
+    """
+    Collects the date header and the event labels from the HTML source of a schedule page.
+    """
+
+    label_suffixes = ('_lblStartTime', '_lblEndTime', '_lblTitle')
+
+    # elements without end tags
+    void_tags = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'
+    }
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.date_titles = []
+        self.appointments = []  # id prefixes of appointments in event_container_id, in page order
+        self.labels = {}  # maps (id prefix, label suffix) to list of label texts
+
+        # open elements, as (tag, id of appointment layer or None) pairs
+        self._open = []
+
+        self._label = None  # (id prefix, label suffix) of the label currently being read
+        self._label_depth = 0
+        self._text = []
+
+    def _layer(self):
+        """
+        Id of the appointment layer nearest to the current position, or None if outside of any.
+        """
+
+        for _, layer in reversed(self._open):
+            if layer is not None:
+                return layer
+
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        elem_id = attrs.get('id') or ''
+
+        if 'dxscDateHeader_Metropolis' in (attrs.get('class') or '').split():
+            self.date_titles.append(attrs.get('title') or '')
+
+        if elem_id.endswith('_appointmentDiv') and self._layer() == event_container_id:
+            self.appointments.append(elem_id[:-len('appointmentDiv')])
+
+        if tag not in self.void_tags:
+            self._open.append((tag, elem_id if elem_id.endswith('appointmentLayer') else None))
+
+        if self._label is not None:
+            if tag == self._label_tag:
+                self._label_depth += 1
+            return
+
+        for suffix in self.label_suffixes:
+            if elem_id.endswith(suffix):
+                self._label = (elem_id[:-len(suffix) + 1], suffix)
+                self._label_tag = tag
+                self._label_depth = 1
+                self._text = []
+
+    def handle_endtag(self, tag):
+        # close the element, along with any unclosed elements inside it
+        for i in range(len(self._open) - 1, -1, -1):
+            if self._open[i][0] == tag:
+                del self._open[i:]
+                break
+
+        if self._label is not None and tag == self._label_tag:
+            self._label_depth -= 1
+            if self._label_depth == 0:
+                # collapse whitespace the way the browser's innerText does
+                self.labels.setdefault(self._label, []).append(u' '.join(u''.join(self._text).split()))
+                self._label = None
+
+    def handle_data(self, data):
+        if self._label is not None:
+            self._text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+
+def parse_events(page_source):
+    """
+    Parse the list of events from the HTML source of a schedule page, without a browser.
+
+    Gives the same results as get_events, so pages can be parsed away from the thread driving the browser.
+    Like get_events, only looks at appointments in event_container_id.
+
+    Parameters
+    ----------
+    page_source : unicode
+        HTML source of the page, e.g. from browser.page_source.
+
+    Returns
+    -------
+    parsed_events : list
+        List of row tuples for the events table, as returned by get_events.
+    """
+
+    parser = _EventPageParser()
+    parser.feed(page_source)
+    parser.close()
+
+    assert len(parser.date_titles) == 1, \
+        "%d dates found on page. Expecting page showing one day's schedule." % len(parser.date_titles)
+    day_str, month_str, year_str = parser.date_titles[0].split()
+    date = year, month, day = int(year_str), month_str2num[month_str], int(day_str)
+
+    parsed_events = []
+
+    for prefix in parser.appointments:
+        texts = {}
+        for suffix in _EventPageParser.label_suffixes:
+            found = parser.labels.get((prefix, suffix), [])
+            assert len(found) == 1, 'Could not uniquely determine %s for event `%s`.' % (suffix[4:], prefix)
+            texts[suffix] = found[0]
+
+        start_time = datetime.datetime.strptime('%d-%d-%d ' % date + texts['_lblStartTime'], '%Y-%m-%d %I:%M %p-')
+        end_time = datetime.datetime.strptime('%d-%d-%d ' % date + texts['_lblEndTime'], '%Y-%m-%d %I:%M %p')
+
+        parsed_events.append(
+            (year, month, day, start_time.strftime(datetime_fmt), end_time.strftime(datetime_fmt), texts['_lblTitle'])
+        )
+
+    return parsed_events
+
+
 def nav_to_url(url):
     """
     Ask the browser to fetch the page located at url.
 
+    The request is paced by the shared rate limiter.
+
     Parameters
     ----------
     url : str
         URL of page.
     """
 
-    browser.get(url)
+    with limiter.request():
+        browser.get(url)
 
 
 def nav_to_local_file(filename):
@@ -229,8 +565,9 @@ def nav_to_local_file(filename):
         Filename of page to fetch.
     """
 
+    # local files don't touch the server, so skip the rate limiter
     url = urlparse.urljoin('file:', urllib.pathname2url(os.path.abspath(filename)))
-    nav_to_url(url)
+    browser.get(url)
 
 
 def export_page_to_file(filename):
@@ -283,6 +620,9 @@ def init_db_con(con):
         """
     )
 
+    init_refresh_table(con)
+    init_summary_table(con)
+
 def init_db(filename):
     """
     Utility function that wraps around init_db_con.
@@ -339,7 +679,341 @@ def update_day(con, year, month, day, event_tuples):
     c.execute('DELETE FROM log WHERE sched_day = ?', (datestr,))
     c.execute('INSERT INTO log VALUES (?, ?)', (datestr, mtime))
 
+    # keep the summary for this day in step with its events
+    c.execute('INSERT OR REPLACE INTO day_summary VALUES (?, ?,?,?, ?,?,?)', (datestr,) + summarize_day(event_tuples))
+
+    con.commit()
+
+def init_summary_table(con):
+    """
+    Create the table of per-day summaries, if it doesn't exist yet, and fill it in from the events table.
+
+    update_day keeps the summary of a day up to date whenever the day's events are replaced.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    """
+
+    c = con.cursor()
+
+    columns = [r[1] for r in c.execute('PRAGMA table_info(day_summary)')]
+    if columns == summary_columns:
+        return
+
+    # the summaries only hold data derived from the events table, so a table with outdated columns is rebuilt
+    c.execute('DROP TABLE IF EXISTS day_summary')
+
+    # database columns
+    # day, number of events, start of first event, end of last event,
+    # JSON list of [start, end] intervals during which some event is on,
+    # JSON object of total minutes scheduled per event category (see event_categories),
+    # JSON object of [start, end] intervals per event category
+    c.execute(
+        """
+        CREATE TABLE day_summary
+        (sched_day text PRIMARY KEY, n_events integer, first_start text, last_end text,
+         busy_intervals text, category_minutes text, category_intervals text)
+        """
+    )
+
+    # summarize days that already have events
+    days = c.execute('SELECT DISTINCT year, month, day FROM events').fetchall()
+    for year, month, day in days:
+        event_tuples = c.execute(
+            'SELECT * FROM events WHERE year=? AND month=? AND day=?', (year, month, day)
+        ).fetchall()
+        datestr = datetime.date(year=year, month=month, day=day).strftime(date_fmt)
+        c.execute('INSERT INTO day_summary VALUES (?, ?,?,?, ?,?,?)', (datestr,) + summarize_day(event_tuples))
+
+    con.commit()
+
+# columns of the day_summary table, in order
+summary_columns = [
+    'sched_day', 'n_events', 'first_start', 'last_end', 'busy_intervals', 'category_minutes', 'category_intervals'
+]
+
+def event_category(description):
+    """
+    Activity category of an event, e.g. 'rec_swim' or 'lessons', according to event_categories.
+
+    Returns 'other' if no category matches the description.
+    """
+
+    for category, regex in event_categories:
+        if re.search(regex, description, re.IGNORECASE):
+            return category
+
+    return 'other'
+
+def merge_intervals(intervals):
+    """
+    Merge overlapping or touching intervals.
+
+    Parameters
+    ----------
+    intervals : list
+        List of (start, end) tuples. Any type that compares in time order works, e.g. datetime_fmt strings.
+
+    Returns
+    -------
+    merged : list
+        List of [start, end] lists, sorted by start, with no two overlapping.
+    """
+
+    merged = []
+
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+def summarize_day(event_tuples):
+    """
+    Compute the summary of one day's events, as stored in the day_summary table.
+
+    Parameters
+    ----------
+    event_tuples : list of row tuples for the events table
+        All events on the day.
+
+    Returns
+    -------
+    summary : tuple
+        Number of events, start of first event, end of last event, busy intervals as JSON,
+        minutes per category as JSON, and merged intervals per category as JSON.
+        Start and end are None on days without events.
+    """
+
+    intervals = [(e[3], e[4]) for e in event_tuples]
+
+    category_minutes = {}
+    category_intervals = {}
+    for e in event_tuples:
+        start = datetime.datetime.strptime(e[3], datetime_fmt)
+        end = datetime.datetime.strptime(e[4], datetime_fmt)
+        category = event_category(e[5])
+        category_minutes[category] = category_minutes.get(category, 0) + int((end - start).total_seconds() // 60)
+        category_intervals.setdefault(category, []).append((e[3], e[4]))
+
+    category_intervals = {category: merge_intervals(ivs) for category, ivs in category_intervals.items()}
+
+    first_start = min(start for start, _ in intervals) if intervals else None
+    last_end = max(end for _, end in intervals) if intervals else None
+
+    return (
+        len(event_tuples), first_start, last_end,
+        json.dumps(merge_intervals(intervals)), json.dumps(category_minutes, sort_keys=True),
+        json.dumps(category_intervals, sort_keys=True)
+    )
+
+def get_summaries(con, start_date, end_date):
+    """
+    Read the summaries of a range of days.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    start_date, end_date : datetime.date
+        First and last day to read, inclusive.
+
+    Returns
+    -------
+    summaries : list
+        One dict per summarized day, in date order, with keys 'day' (a date object), 'n_events', 'first_start',
+        'last_end', 'busy_intervals' (list of [start, end]), 'category_minutes' (dict of minutes per category)
+        and 'category_intervals' (dict of [start, end] lists per category).
+        For example, the lane/rec swim windows of a day are summary['category_intervals'].get('rec_swim', []).
+        Days that haven't been scraped yet are left out.
+    """
+
+    rows = con.execute(
+        'SELECT * FROM day_summary WHERE sched_day >= ? AND sched_day <= ? ORDER BY sched_day',
+        (start_date.strftime(date_fmt), end_date.strftime(date_fmt))
+    )
+
+    return [
+        {
+            'day': datetime.datetime.strptime(sched_day, date_fmt).date(),
+            'n_events': n_events,
+            'first_start': first_start,
+            'last_end': last_end,
+            'busy_intervals': json.loads(busy_intervals),
+            'category_minutes': json.loads(category_minutes),
+            'category_intervals': json.loads(category_intervals),
+        }
+        for sched_day, n_events, first_start, last_end, busy_intervals, category_minutes, category_intervals in rows
+    ]
+
+def init_refresh_table(con):
+    """
+    Create the table of on-demand refresh requests, if it doesn't exist yet.
+
+    Other processes (e.g. a front-end) add rows to this table with request_refresh to ask the daemon
+    to refresh a day right away.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    """
+
+    # database columns
+    # request id, day to refresh, time requested, time completed, error message if the refresh failed
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS refresh_requests
+        (id integer PRIMARY KEY, sched_day text, requested text, completed text, error text)
+        """
+    )
+    con.commit()
+
+def request_refresh(con, year, month, day):
+    """
+    Ask the daemon to refresh the schedule for a day as soon as possible.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    year, month, day : int, int, int
+        Date to refresh.
+
+    Returns
+    -------
+    request_id : int
+        Id of the request, to pass on to wait_for_refresh.
+    """
+
+    datestr = datetime.date(year=year, month=month, day=day).strftime(date_fmt)
+    requested = datetime.datetime.now().strftime(datetime_fmt)
+
+    c = con.cursor()
+    c.execute('INSERT INTO refresh_requests (sched_day, requested) VALUES (?, ?)', (datestr, requested))
+    con.commit()
+
+    return c.lastrowid
+
+def wait_for_refresh(con, request_id, timeout_sec=60., poll_interval=0.5):
+    """
+    Block until the daemon has committed the day asked for by request_refresh.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    request_id : int
+        Id returned by request_refresh.
+    timeout_sec : float
+        Length of time to wait before raising a RuntimeError.
+    poll_interval : float
+        Time between checks of the database, in seconds.
+    """
+
+    time_slept = 0.
+
+    while True:
+        row = con.execute('SELECT completed, error FROM refresh_requests WHERE id = ?', (request_id,)).fetchone()
+        if row is None:
+            raise ValueError('No refresh request with id %d.' % request_id)
+        completed, error = row
+
+        if completed is not None:
+            if error is not None:
+                raise RuntimeError('Refresh failed: %s' % error)
+            return
+
+        if time_slept >= timeout_sec:
+            raise RuntimeError('Timeout occurred when waiting for refresh.')
+
+        time.sleep(poll_interval)
+        time_slept += poll_interval
+
+def pending_refreshes(con):
+    """
+    List refresh requests that haven't been handled yet, oldest first.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+
+    Returns
+    -------
+    pending : list
+        List of (request id, date object) tuples.
+    """
+
+    rows = con.execute('SELECT id, sched_day FROM refresh_requests WHERE completed IS NULL ORDER BY id')
+
+    return [(request_id, datetime.datetime.strptime(sched_day, date_fmt).date()) for request_id, sched_day in rows]
+
+def mark_refresh_done(con, request_id, error=None):
+    """
+    Record that a refresh request has been handled.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    request_id : int
+        Id of the request.
+    error : str or None
+        Reason the refresh failed, or None if it succeeded.
+    """
+
+    completed = datetime.datetime.now().strftime(datetime_fmt)
+
+    con.rollback()
+    con.execute('UPDATE refresh_requests SET completed = ?, error = ? WHERE id = ?', (completed, error, request_id))
     con.commit()
 
+def export_events(con, fd, start_date=None, end_date=None):
+    """
+    Write events from the database to a file in CSV format, ordered by start time.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        Connection to an open database.
+    fd : file
+        Open file to write to.
+    start_date, end_date : datetime.date or None
+        Only export events on days between start_date and end_date, inclusive.
+        If None, the range is unbounded on that side.
+
+    Returns
+    -------
+    n_rows : int
+        Number of events written.
+    """
+
+    query = 'SELECT start_time, end_time, description FROM events WHERE 1'
+    params = []
+
+    if start_date is not None:
+        query += ' AND date(start_time) >= date(?)'
+        params.append(start_date.strftime(date_fmt))
+    if end_date is not None:
+        query += ' AND date(start_time) <= date(?)'
+        params.append(end_date.strftime(date_fmt))
+
+    query += ' ORDER BY start_time, end_time'
+
+    writer = csv.writer(fd)
+    writer.writerow(('start_time', 'end_time', 'description'))
+
+    n_rows = 0
+    for start_time, end_time, description in con.execute(query, params):
+        writer.writerow((start_time, end_time, description.encode('utf-8')))
+        n_rows += 1
+
+    return n_rows
+
 if __name__ == '__main__':
     main()
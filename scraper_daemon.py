@@ -2,28 +2,52 @@
 Background service/daemon which periodically scrapes the schedule.
 """
 
+import argparse
 from collections import defaultdict
 import datetime
 import os
+import Queue
 import sqlite3
+import sys
+import threading
 import time
 
-# Daemon or one of its prerequisite libraries may not be available, particularly on Windows.
-try:
-    import daemon
-except ImportError:
-    print 'Could not create daemon process. Running in current process.'
-
 import schedule_scraper as scsc
 
 # if False, run a headless browser, and run program on a background service via daemon
 debug_mode = True
 
+# If True, start the browser with a profile that skips images, stylesheets and other unneeded resources.
+# Off by default until the lean profile has been checked against the live site.
+lean_browser = False
+
+# how often to check for on-demand refresh requests while sleeping, in seconds
+poll_interval = 1.
+
 # how many minutes to oversleep, to ensure that there is stuff to do after waking up
 sleep_buffer = 5.
 
 db_fn = 'test08.db'
 
+# How long to wait before retrying a day that failed to load, in minutes.
+# Doubles with each consecutive failure of the same day, up to max_retry_delay.
+retry_delay = 2.
+max_retry_delay = 60.
+
+# days that failed to load, mapped to (number of consecutive failures, time of next retry)
+_failed_days = {}
+
+# Update pipeline settings (see run_pipeline).
+# Fetching is limited to one thread, since there is a single browser, and the rate limiter caps requests anyway.
+# Number of threads parsing pages.
+# Parsing is pure Python, so under the GIL extra threads don't parse any faster; they only reorder the output.
+# One parser already overlaps with fetching and writing.
+parse_workers = 1
+# number of fetched pages allowed to wait for a parser before fetching pauses
+page_queue_size = 2
+# number of parsed days allowed to wait for the database writer before parsing pauses
+batch_queue_size = 4
+
 # Rules describing when to update which day's schedule.
 # Applies to a range of days, counted relative to today.
 # 'period' specifies update frequency, in minutes.
@@ -48,7 +72,7 @@ rules = [
     # }
 ]
 
-def maintain_schedules(db_fn, rules, sleep_buffer=5.):
+def maintain_schedules(db_fn, rules, sleep_buffer=5., prewarm=True):
     """
     Update the schedules periodically.
 
@@ -60,13 +84,25 @@ def maintain_schedules(db_fn, rules, sleep_buffer=5.):
         List of rules describing update frequency for different spans of dates.
     sleep_buffer : float
         Amount of time to oversleep, in minutes.
+    prewarm : bool
+        If True, start the browser and load the facility page in the background right away.
+        Otherwise, the browser is only started once a day needs an update.
+        Pre-warming pays off when no day is due at startup, since the first due day then finds the browser ready.
+        When a day is due right away, it only overlaps the browser start with setting up the database.
     """
 
+    if prewarm:
+        scsc.prewarm_browser(scsc.page_url_stub + scsc.pac_pool_id, debug_mode, lean_browser)
+
     if not os.path.exists(db_fn):
         scsc.init_db(db_fn)
 
-    scsc.init_browser(debug_mode)
-    scsc.nav_to_url(scsc.page_url_stub + scsc.pac_pool_id)
+    # connection used to watch for refresh requests between updates
+    con = sqlite3.connect(db_fn)
+
+    # databases created before refresh requests and day summaries existed don't have the tables yet
+    scsc.init_refresh_table(con)
+    scsc.init_summary_table(con)
 
     while True:
         wakeup_dt = datetime.datetime.now()
@@ -79,14 +115,49 @@ def maintain_schedules(db_fn, rules, sleep_buffer=5.):
         print 'Should wake up at %s.' % (
         (datetime.datetime.now() + datetime.timedelta(minutes=minutes_left)).strftime(scsc.datetime_fmt))
 
-        time.sleep(minutes_left * 60 + sleep_buffer)
-        print 'Done sleeping.'
+        if wait_for_wakeup(con, minutes_left * 60 + sleep_buffer):
+            print 'Woken up by refresh request.'
+        else:
+            print 'Done sleeping.'
+
+
+def wait_for_wakeup(con, timeout_sec):
+    """
+    Sleep until the timeout passes, or a refresh request comes in.
+
+    Parameters
+    ----------
+    con : sqlite3 connection
+        Connection to database
+    timeout_sec : float
+        Longest time to sleep, in seconds.
+
+    Returns
+    -------
+    requested : bool
+        True if woken up early by a refresh request.
+    """
+
+    time_slept = 0.
+
+    while time_slept < timeout_sec:
+        if scsc.pending_refreshes(con):
+            return True
+
+        interval = min(poll_interval, timeout_sec - time_slept)
+        time.sleep(interval)
+        time_slept += interval
+
+    return False
 
 
 def update(db_fn, rules):
     """
     Update the schedule.
 
+    Days are fetched, parsed and written in a pipeline (see run_pipeline), so that waiting on the server,
+    parsing pages and writing to the database overlap.
+
     Parameters
     ----------
     db_fn : str
@@ -106,6 +177,9 @@ def update(db_fn, rules):
     # Update this value later.
     next_wakeup_time = datetime.datetime.now() + datetime.timedelta(minutes=rules[0]['period'])
 
+    # days needing an update, in the order the rules list them
+    due_dates = []
+
     for rule in rules:
         # list of days that this rule applies to
         dates = get_dates(rule)
@@ -115,25 +189,305 @@ def update(db_fn, rules):
 
         for date in dates:
             datestr = date.strftime(scsc.date_fmt)
-            if next_updates[date] < datetime.datetime.now():
+            if date in _failed_days and _failed_days[date][1] > datetime.datetime.now():
+                retry_time = _failed_days[date][1]
+                print '%s failed to load, retrying at %s.' % (datestr, retry_time.strftime(scsc.datetime_fmt))
+                next_wakeup_time = min(next_wakeup_time, retry_time)
+            elif next_updates[date] < datetime.datetime.now():
                 print '%s needs update.' % datestr
-                scsc.nav_to_date(date.year, date.month, date.day)
-                events = scsc.get_events()
-                scsc.update_day(con, date.year, date.month, date.day, events)
-                print 'Done'
+                due_dates.append(date)
             else:
                 print '%s does not need update until %s.' % (datestr, next_updates[date])
                 next_wakeup_time = min(next_wakeup_time, next_updates[date])
 
+    failed_dates = run_pipeline(con, db_fn, due_dates)
+
+    # back off from days that failed, without holding up the others
+    for date in due_dates:
+        if date in failed_dates:
+            next_wakeup_time = min(next_wakeup_time, record_failure(date))
+        else:
+            _failed_days.pop(date, None)
+
+    # forget failures of days that have passed
+    for date in list(_failed_days):
+        if date < datetime.date.today():
+            del _failed_days[date]
+
     clear_old_rows(con)
 
     con.close()
 
-    minutes_left = (next_wakeup_time - datetime.datetime.now()).total_seconds() / 60
+    minutes_left = max(0., (next_wakeup_time - datetime.datetime.now()).total_seconds() / 60)
 
     return minutes_left
 
 
+def run_pipeline(con, db_fn, due_dates):
+    """
+    Fetch, parse and store the schedules of the given days, along with any requested refreshes.
+
+    Stages run concurrently, connected by bounded queues:
+    one thread drives the browser (fetch_pages), parse_workers threads parse the pages (parse_pages),
+    and the calling thread writes the results to the database.
+
+    Parameters
+    ----------
+    con : sqlite3 connection
+        Connection to database, used for writing.
+    db_fn : str
+        Name of database file, used to check for refresh requests from the fetching thread.
+    due_dates : list
+        Date objects of the days to update.
+
+    Returns
+    -------
+    failed_dates : list
+        Date objects of the days in due_dates that failed to load.
+    """
+
+    work = pending_work(db_fn, due_dates)
+    pages = threaded_stage(fetch_pages, work, 1, page_queue_size)
+    batches = threaded_stage(parse_pages, pages, parse_workers, batch_queue_size)
+
+    failed_dates = []
+
+    for request_id, date, events, error in batches:
+        datestr = date.strftime(scsc.date_fmt)
+
+        if error is not None:
+            print 'Failed to load %s: %s' % (datestr, error)
+            # failed refreshes are reported back to the requester instead of retried
+            if request_id is None:
+                failed_dates.append(date)
+        else:
+            scsc.update_day(con, date.year, date.month, date.day, events)
+            print 'Done %s' % datestr
+
+        if request_id is not None:
+            scsc.mark_refresh_done(con, request_id, error)
+
+    return failed_dates
+
+
+def record_failure(date):
+    """
+    Record that a day failed to load, and work out when to retry it.
+
+    Parameters
+    ----------
+    date : datetime.date
+        Day that failed to load.
+
+    Returns
+    -------
+    retry_time : datetime.datetime
+        Time to retry the day.
+    """
+
+    n_failures = _failed_days[date][0] + 1 if date in _failed_days else 1
+    delay = min(retry_delay * 2 ** (n_failures - 1), max_retry_delay)
+    retry_time = datetime.datetime.now() + datetime.timedelta(minutes=delay)
+
+    _failed_days[date] = (n_failures, retry_time)
+
+    return retry_time
+
+
+def pending_work(db_fn, due_dates):
+    """
+    Generate the days to fetch, letting refresh requests jump the queue.
+
+    Checks for new refresh requests before every scheduled day.
+
+    Parameters
+    ----------
+    db_fn : str
+        Name of database file to use.
+    due_dates : list
+        Date objects of the days to update.
+
+    Yields
+    ------
+    request_id : int or None
+        Id of the refresh request, or None for a scheduled update.
+    date : datetime.date
+    """
+
+    # Opened lazily, in the thread consuming this generator. If the pipeline stops early, the generator is
+    # closed from whichever thread collects it, so allow the connection to be closed from another thread.
+    con = sqlite3.connect(db_fn, check_same_thread=False)
+    dispatched = set()
+
+    try:
+        for date in due_dates + [None]:
+            for request_id, refresh_date in scsc.pending_refreshes(con):
+                if request_id not in dispatched:
+                    print 'Refresh requested for %s.' % refresh_date.strftime(scsc.date_fmt)
+                    dispatched.add(request_id)
+                    yield request_id, refresh_date
+
+            if date is not None:
+                yield None, date
+    finally:
+        con.close()
+
+
+def fetch_pages(work):
+    """
+    Pipeline stage: load each day in the browser, and pass on the page source.
+
+    Parameters
+    ----------
+    work : iterable
+        (request id, date) tuples, as generated by pending_work.
+
+    Yields
+    ------
+    request_id, date
+        As received.
+    page_source : unicode or None
+        HTML source of the day's schedule, or None if it failed to load.
+    error : str or None
+        Reason the page failed to load.
+    """
+
+    from selenium.common.exceptions import WebDriverException
+
+    for request_id, date in work:
+        try:
+            ensure_browser()
+            scsc.nav_to_date(date.year, date.month, date.day)
+        except (ValueError, RuntimeError, AssertionError, WebDriverException) as e:
+            yield request_id, date, None, str(e)
+            continue
+
+        yield request_id, date, scsc.browser.page_source, None
+
+
+def parse_pages(pages):
+    """
+    Pipeline stage: parse the events out of each page.
+
+    Parameters
+    ----------
+    pages : iterable
+        Output of fetch_pages.
+
+    Yields
+    ------
+    request_id, date
+        As received.
+    events : list or None
+        Row tuples for the events table, or None if the page failed to load or to parse.
+    error : str or None
+        Reason the page failed to load or to parse.
+    """
+
+    for request_id, date, page_source, error in pages:
+        if error is not None:
+            yield request_id, date, None, error
+            continue
+
+        try:
+            events = scsc.parse_events(page_source)
+        except (AssertionError, ValueError, KeyError) as e:
+            yield request_id, date, None, 'Failed to parse page: %s' % e
+            continue
+
+        yield request_id, date, events, None
+
+
+# marks a worker in threaded_stage finishing
+_stage_done = object()
+
+def threaded_stage(stage, items, n_workers=1, maxsize=1):
+    """
+    Run a pipeline stage in background threads, streaming its output through a bounded queue.
+
+    The workers block once maxsize results are waiting to be consumed, so a slow consumer holds back
+    the stage, and in turn the stages before it.
+
+    Parameters
+    ----------
+    stage : function
+        Generator function taking an iterable of inputs and yielding outputs.
+        With several workers, each one runs its own copy of stage, and they share the inputs between them.
+    items : iterable
+        Inputs to the stage.
+    n_workers : int
+        Number of threads running the stage.
+        If more than one, outputs can come out in a different order than the inputs went in.
+    maxsize : int
+        Maximum number of outputs waiting in the queue.
+
+    Returns
+    -------
+    outputs : generator
+        Outputs of the stage. An exception raised in a worker is raised here.
+    """
+
+    outbox = Queue.Queue(maxsize)
+    items = iter(items)
+    lock = threading.Lock()
+
+    def shared_items():
+        while True:
+            with lock:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def work():
+        try:
+            for output in stage(shared_items()):
+                outbox.put((output, None))
+        except Exception:
+            outbox.put((None, sys.exc_info()))
+        finally:
+            outbox.put(_stage_done)
+
+    for _ in range(n_workers):
+        worker = threading.Thread(target=work, name=stage.__name__)
+        worker.daemon = True
+        worker.start()
+
+    def outputs():
+        n_done = 0
+        while n_done < n_workers:
+            entry = outbox.get()
+            if entry is _stage_done:
+                n_done += 1
+                continue
+
+            output, exc_info = entry
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield output
+
+    return outputs()
+
+
+def ensure_browser():
+    """
+    Make sure the browser is running and showing the facility page, starting it if necessary.
+
+    Raises a RuntimeError if a pre-warmed browser failed to start. The next call then starts a fresh one.
+    """
+
+    try:
+        scsc.wait_for_browser()
+    except Exception as e:
+        scsc.quit_browser()
+        raise RuntimeError('Browser failed to start: %s' % e)
+
+    if scsc.browser is None:
+        scsc.init_browser(debug_mode, lean_browser)
+        scsc.nav_to_url(scsc.page_url_stub + scsc.pac_pool_id)
+
+
 def get_dates(rule):
     """
     Returns a list of date objects that the rule applies to.
@@ -197,9 +551,134 @@ def clear_old_rows(con):
     c.execute('DELETE FROM log WHERE date(sched_day) < date(?)', (todaystr,))
     con.commit()
 
-if __name__ == '__main__':
-    if debug_mode or 'daemon' not in locals():
-        maintain_schedules(db_fn, rules, sleep_buffer)
+def run_scrape(args):
+    """
+    Entry point for the `scrape` command: keep the schedules up to date.
+    """
+
+    global lean_browser, parse_workers
+    lean_browser = args.lean
+    parse_workers = args.parse_workers
+
+    foreground = args.foreground or debug_mode
+
+    if not foreground:
+        # Daemon or one of its prerequisite libraries may not be available, particularly on Windows.
+        try:
+            import daemon
+        except ImportError:
+            print 'Could not create daemon process. Running in current process.'
+            foreground = True
+
+    if foreground:
+        maintain_schedules(args.db, rules, sleep_buffer, prewarm=args.prewarm)
     else:
         with daemon.DaemonContext(working_directory='.', stdout=open('./scsc_stdout.log', 'a'), stderr=open('./scsc_stderr.log', 'a')):
-            maintain_schedules(db_fn, rules, sleep_buffer)
\ No newline at end of file
+            maintain_schedules(args.db, rules, sleep_buffer, prewarm=args.prewarm)
+
+
+def run_initdb(args):
+    """
+    Entry point for the `initdb` command: create the database tables.
+    """
+
+    scsc.init_db(args.db)
+
+
+def run_clean(args):
+    """
+    Entry point for the `clean` command: delete stale rows from the database.
+    """
+
+    con = sqlite3.connect(args.db)
+    clear_old_rows(con)
+    con.close()
+
+
+def run_refresh(args):
+    """
+    Entry point for the `refresh` command: ask the running daemon to refresh a day, and wait until it is done.
+    """
+
+    date = datetime.datetime.strptime(args.date, scsc.date_fmt).date()
+
+    con = sqlite3.connect(args.db)
+    scsc.init_refresh_table(con)
+    request_id = scsc.request_refresh(con, date.year, date.month, date.day)
+
+    try:
+        scsc.wait_for_refresh(con, request_id, args.timeout)
+    except RuntimeError as e:
+        print e
+        if request_id in [pending_id for pending_id, _ in scsc.pending_refreshes(con)]:
+            print 'Is the scraper running? The request stays queued, and will run once it is.'
+        sys.exit(1)
+    finally:
+        con.close()
+
+    print 'Refreshed %s.' % args.date
+
+
+def run_export(args):
+    """
+    Entry point for the `export` command: write events from the database as CSV.
+    """
+
+    parse_date = lambda s: datetime.datetime.strptime(s, scsc.date_fmt).date() if s else None
+
+    con = sqlite3.connect(args.db)
+    if args.output == '-':
+        scsc.export_events(con, sys.stdout, parse_date(args.start), parse_date(args.end))
+    else:
+        with open(args.output, 'wb') as fd:
+            scsc.export_events(con, fd, parse_date(args.start), parse_date(args.end))
+    con.close()
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments.
+
+    Parameters
+    ----------
+    argv : list or None
+        Arguments to parse. If None, sys.argv is used.
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--db', default=db_fn, help='database file (default: %(default)s)')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('scrape', help='periodically scrape the schedule into the database')
+    p.add_argument('--foreground', action='store_true', help='do not detach into a background daemon')
+    p.add_argument('--no-prewarm', dest='prewarm', action='store_false',
+                   help='only start the browser once a day needs an update')
+    p.add_argument('--lean', action='store_true',
+                   help='start the browser with a profile that skips images, stylesheets and fonts')
+    p.add_argument('--parse-workers', type=int, default=parse_workers,
+                   help='number of threads parsing pages; more than one does not speed up parsing, '
+                        'which is CPU-bound Python (default: %(default)s)')
+    p.set_defaults(func=run_scrape)
+
+    p = subparsers.add_parser('initdb', help='create an empty database')
+    p.set_defaults(func=run_initdb)
+
+    p = subparsers.add_parser('clean', help='delete stale rows from the database')
+    p.set_defaults(func=run_clean)
+
+    p = subparsers.add_parser('refresh', help='ask the running scraper to refresh a day right away')
+    p.add_argument('date', help='day to refresh, as YYYY-MM-DD')
+    p.add_argument('--timeout', type=float, default=60., help='seconds to wait for the refresh (default: %(default)s)')
+    p.set_defaults(func=run_refresh)
+
+    p = subparsers.add_parser('export', help='export events as CSV')
+    p.add_argument('--start', help='first day to export, as YYYY-MM-DD')
+    p.add_argument('--end', help='last day to export, as YYYY-MM-DD')
+    p.add_argument('-o', '--output', default='-', help='output file (default: stdout)')
+    p.set_defaults(func=run_export)
+
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
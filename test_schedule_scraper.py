@@ -1,13 +1,28 @@
+import codecs
+import csv
 import datetime
 import os
-from unittest import TestCase
+import re
+import shutil
+from StringIO import StringIO
+import tempfile
+from unittest import skipUnless, TestCase
+import urlparse
 
 import sqlite3
+import time
 
+import rate_limiter
 import schedule_scraper as scsc
 
 import scraper_daemon as sd
 
+try:
+    import selenium
+    selenium_available = True
+except ImportError:
+    selenium_available = False
+
 class TestScraperDaemon(TestCase):
 
     # test that clear_old_rows works
@@ -44,6 +59,484 @@ class TestScraperDaemon(TestCase):
         self.assertEqual(dates2[-1] - today, delta(10))
         self.assertEqual(len(dates2), 10)
 
+    def test_wait_for_wakeup(self):
+        """
+        Test that sleeping is cut short by a refresh request.
+        """
+
+        con = sqlite3.connect(':memory:')
+        scsc.init_db_con(con)
+
+        sd.poll_interval, old_poll_interval = 0.01, sd.poll_interval
+        try:
+            self.assertFalse(sd.wait_for_wakeup(con, 0.05))
+
+            scsc.request_refresh(con, 2016, 9, 21)
+            start = time.time()
+            self.assertTrue(sd.wait_for_wakeup(con, 60.))
+            self.assertLess(time.time() - start, 1.)
+        finally:
+            sd.poll_interval = old_poll_interval
+            con.close()
+
+    def test_record_failure(self):
+        """
+        Test that the retry delay of a failing day doubles with each failure, up to the maximum.
+        """
+
+        date = datetime.date.today()
+        minutes_until = lambda t: (t - datetime.datetime.now()).total_seconds() / 60
+
+        sd.retry_delay, sd.max_retry_delay, old_delays = 2., 5., (sd.retry_delay, sd.max_retry_delay)
+        try:
+            self.assertAlmostEqual(minutes_until(sd.record_failure(date)), 2., places=1)
+            self.assertAlmostEqual(minutes_until(sd.record_failure(date)), 4., places=1)
+            self.assertAlmostEqual(minutes_until(sd.record_failure(date)), 5., places=1)
+            self.assertEqual(sd._failed_days[date][0], 3)
+        finally:
+            sd.retry_delay, sd.max_retry_delay = old_delays
+            sd._failed_days.pop(date, None)
+
+    @skipUnless(selenium_available, 'selenium is not installed')
+    def test_fetch_pages_prewarm_failure(self):
+        """
+        Test that a browser that failed to pre-warm is reported like a page that failed to load.
+        """
+
+        scsc._prewarm_error = RuntimeError('Could not start PhantomJS.')
+        try:
+            results = list(sd.fetch_pages([(None, datetime.date.today())]))
+        finally:
+            scsc._prewarm_error = None
+
+        self.assertEqual(len(results), 1)
+        request_id, date, page_source, error = results[0]
+        self.assertEqual(page_source, None)
+        self.assertIn('Could not start PhantomJS.', error)
+
+    @skipUnless(selenium_available, 'selenium is not installed')
+    def test_fetch_pages_webdriver_error(self):
+        """
+        Test that a selenium error while loading a day is reported as a failed day, instead of stopping the update,
+        and that the day then backs off.
+        """
+
+        from selenium.common.exceptions import NoSuchElementException
+
+        def nav_to_error_page(year, month, day):
+            raise NoSuchElementException('Unable to find element with class name dxscDateHeader_Metropolis')
+
+        tmp_dir = tempfile.mkdtemp()
+        db_fn = os.path.join(tmp_dir, 'test.db')
+        scsc.init_db(db_fn)
+        con = sqlite3.connect(db_fn)
+
+        date = datetime.date.today()
+        ensure_browser, nav_to_date = sd.ensure_browser, scsc.nav_to_date
+        sd.ensure_browser, scsc.nav_to_date = lambda: None, nav_to_error_page
+        try:
+            minutes_left = sd.update(db_fn, [{'start': 0, 'end': 0, 'period': 60}])
+
+            # the failed day backs off instead of being retried immediately
+            self.assertEqual(sd._failed_days[date][0], 1)
+            self.assertAlmostEqual(minutes_left, sd.retry_delay, places=1)
+        finally:
+            sd.ensure_browser, scsc.nav_to_date = ensure_browser, nav_to_date
+            sd._failed_days.pop(date, None)
+            con.close()
+            shutil.rmtree(tmp_dir)
+
+    def test_threaded_stage(self):
+        """
+        Test that a threaded stage passes on every output, and re-raises errors from its workers.
+        """
+
+        def double(items):
+            for item in items:
+                yield 2 * item
+
+        self.assertEqual(list(sd.threaded_stage(double, range(10))), [2 * i for i in range(10)])
+        self.assertEqual(sorted(sd.threaded_stage(double, range(10), n_workers=3)), [2 * i for i in range(10)])
+
+        def fail(items):
+            for item in items:
+                raise ValueError('bad item')
+            yield
+
+        self.assertRaises(ValueError, list, sd.threaded_stage(fail, range(10), n_workers=2))
+
+    def test_run_pipeline(self):
+        """
+        Test that scheduled days and refresh requests flow through the pipeline into the database.
+        Pages come from test_resources instead of the browser.
+        """
+
+        pages = {
+            datetime.date(2016, 9, 21): os.path.join('test_resources', '20160921_schedule.html'),
+            datetime.date(2017, 9, 2): os.path.join('test_resources', '20170902_schedule.html'),
+        }
+
+        # a day whose page loads, but can't be parsed
+        broken_date = datetime.date(2016, 9, 23)
+
+        def fetch_archived_pages(work):
+            for request_id, date in work:
+                if date in pages:
+                    with codecs.open(pages[date], 'r', 'utf-8') as fd:
+                        yield request_id, date, fd.read(), None
+                elif date == broken_date:
+                    yield request_id, date, u'<html><body></body></html>', None
+                else:
+                    yield request_id, date, None, 'Failed to load the requested date.'
+
+        tmp_dir = tempfile.mkdtemp()
+        db_fn = os.path.join(tmp_dir, 'test.db')
+        scsc.init_db(db_fn)
+        con = sqlite3.connect(db_fn)
+
+        sd.fetch_pages, fetch_pages = fetch_archived_pages, sd.fetch_pages
+        try:
+            request_id = scsc.request_refresh(con, 2017, 9, 2)
+            self.assertEqual(sd.run_pipeline(con, db_fn, [datetime.date(2016, 9, 21)]), [])
+
+            summaries = scsc.get_summaries(con, datetime.date(2016, 9, 21), datetime.date(2017, 9, 2))
+            self.assertEqual([(summary['day'], summary['n_events']) for summary in summaries],
+                             [(datetime.date(2016, 9, 21), 11), (datetime.date(2017, 9, 2), 0)])
+            scsc.wait_for_refresh(con, request_id, 0.)
+
+            # failed scheduled days are reported, so they can be retried
+            failed_dates = sd.run_pipeline(con, db_fn, [datetime.date(2016, 9, 21), datetime.date(2016, 9, 22)])
+            self.assertEqual(failed_dates, [datetime.date(2016, 9, 22)])
+
+            # parse failures are reported the same way, without stopping the other days
+            request_id = scsc.request_refresh(con, 2016, 9, 23)
+            failed_dates = sd.run_pipeline(con, db_fn, [broken_date, datetime.date(2017, 9, 2)])
+            self.assertEqual(failed_dates, [broken_date])
+            self.assertRaises(RuntimeError, scsc.wait_for_refresh, con, request_id, 0.)
+            self.assertEqual(scsc.pending_refreshes(con), [])
+        finally:
+            sd.fetch_pages = fetch_pages
+            con.close()
+            shutil.rmtree(tmp_dir)
+
+
+class TestDatabase(TestCase):
+
+    """
+    Tests running only against an in-memory database, with no browser.
+    """
+
+    def setUp(self):
+        self.con = sqlite3.connect(':memory:')
+        scsc.init_db_con(self.con)
+
+        self.events = [
+            (2016, 9, 21, '2016-09-21 13:00:00', '2016-09-21 15:00:00', u'Subject: Varsity Swimming'),
+            (2016, 9, 21, '2016-09-21 08:00:00', '2016-09-21 09:00:00', u'Course: Fall 2016 - Swimming - Fitness and Rec Swim - Fitness and Rec Swim'),
+            (2016, 9, 22, '2016-09-22 08:00:00', '2016-09-22 09:00:00', u'Course: Fall 2016 - Swimming - Fitness and Rec Swim - Fitness and Rec Swim'),
+        ]
+        self.con.executemany('INSERT INTO events VALUES (?,?,?, ?,?,?)', self.events)
+        self.con.commit()
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_export_events(self):
+        """
+        Test that events are exported in order of start time, and that the date range is respected.
+        """
+
+        fd = StringIO()
+        n_rows = scsc.export_events(self.con, fd)
+        rows = list(csv.reader(StringIO(fd.getvalue())))
+
+        self.assertEqual(n_rows, 3)
+        self.assertEqual(rows[0], ['start_time', 'end_time', 'description'])
+        self.assertEqual(rows[1], [
+            '2016-09-21 08:00:00', '2016-09-21 09:00:00',
+            'Course: Fall 2016 - Swimming - Fitness and Rec Swim - Fitness and Rec Swim'
+        ])
+        self.assertEqual(rows[2][2], 'Subject: Varsity Swimming')
+
+        fd = StringIO()
+        n_rows = scsc.export_events(self.con, fd, start_date=datetime.date(2016, 9, 22))
+        self.assertEqual(n_rows, 1)
+
+        fd = StringIO()
+        n_rows = scsc.export_events(self.con, fd, end_date=datetime.date(2016, 9, 21))
+        self.assertEqual(n_rows, 2)
+
+    def test_refresh_requests(self):
+        """
+        Test the life cycle of a refresh request: pending until marked done, then visible to the requester.
+        """
+
+        request_id = scsc.request_refresh(self.con, 2016, 9, 22)
+        self.assertEqual(scsc.pending_refreshes(self.con), [(request_id, datetime.date(2016, 9, 22))])
+        self.assertRaises(RuntimeError, scsc.wait_for_refresh, self.con, request_id, 0.)
+
+        scsc.mark_refresh_done(self.con, request_id)
+        self.assertEqual(scsc.pending_refreshes(self.con), [])
+        scsc.wait_for_refresh(self.con, request_id, 0.)
+
+        # failed refreshes are reported to the requester
+        request_id = scsc.request_refresh(self.con, 2016, 9, 23)
+        scsc.mark_refresh_done(self.con, request_id, 'Date must fall between today and two years from today.')
+        self.assertRaises(RuntimeError, scsc.wait_for_refresh, self.con, request_id, 0.)
+
+        # asking about a request that doesn't exist is an error on the caller's side
+        self.assertRaises(ValueError, scsc.wait_for_refresh, self.con, request_id + 100, 0.)
+
+    def test_day_summary(self):
+        """
+        Test that update_day keeps the day's summary in step with its events, using the events of an archived page.
+        """
+
+        with codecs.open(os.path.join('test_resources', '20160921_schedule.html'), 'r', 'utf-8') as fd:
+            events = scsc.parse_events(fd.read())
+        scsc.update_day(self.con, 2016, 9, 21, events)
+
+        summaries = scsc.get_summaries(self.con, datetime.date(2016, 9, 20), datetime.date(2016, 9, 22))
+        self.assertEqual(len(summaries), 1)
+
+        summary = summaries[0]
+        self.assertEqual(summary['day'], datetime.date(2016, 9, 21))
+        self.assertEqual(summary['n_events'], 11)
+        self.assertEqual(summary['first_start'], '2016-09-21 06:00:00')
+        self.assertEqual(summary['last_end'], '2016-09-21 23:00:00')
+        self.assertEqual(summary['busy_intervals'], [
+            ['2016-09-21 06:00:00', '2016-09-21 09:00:00'],
+            ['2016-09-21 11:00:00', '2016-09-21 16:00:00'],
+            ['2016-09-21 19:00:00', '2016-09-21 21:30:00'],
+            ['2016-09-21 22:00:00', '2016-09-21 23:00:00'],
+        ])
+        self.assertEqual(summary['category_minutes'], {'varsity': 240, 'rec_swim': 240, 'lessons': 240, 'club': 120})
+
+        # lane/rec swim windows are available without looking at the events table
+        self.assertEqual(summary['category_intervals']['rec_swim'], [
+            ['2016-09-21 08:00:00', '2016-09-21 09:00:00'],
+            ['2016-09-21 12:00:00', '2016-09-21 13:00:00'],
+            ['2016-09-21 15:00:00', '2016-09-21 16:00:00'],
+            ['2016-09-21 22:00:00', '2016-09-21 23:00:00'],
+        ])
+        self.assertEqual(summary['category_intervals']['lessons'], [
+            ['2016-09-21 11:00:00', '2016-09-21 12:00:00'],
+            ['2016-09-21 13:00:00', '2016-09-21 14:00:00'],
+            ['2016-09-21 19:00:00', '2016-09-21 20:00:00'],
+        ])
+
+        # replacing the day with no events empties the summary
+        scsc.update_day(self.con, 2016, 9, 21, [])
+        summary = scsc.get_summaries(self.con, datetime.date(2016, 9, 21), datetime.date(2016, 9, 21))[0]
+        self.assertEqual(summary['n_events'], 0)
+        self.assertEqual(summary['first_start'], None)
+        self.assertEqual(summary['busy_intervals'], [])
+        self.assertEqual(summary['category_intervals'], {})
+
+    def test_init_summary_table(self):
+        """
+        Test that summaries are filled in for events already in a database that predates the summary table,
+        and that a summary table with outdated columns is rebuilt.
+        """
+
+        self.con.execute('DROP TABLE day_summary')
+        scsc.init_summary_table(self.con)
+
+        summaries = scsc.get_summaries(self.con, datetime.date(2016, 9, 21), datetime.date(2016, 9, 22))
+        self.assertEqual([summary['n_events'] for summary in summaries], [2, 1])
+        self.assertEqual(summaries[1]['category_minutes'], {'rec_swim': 60})
+
+        self.con.execute('DROP TABLE day_summary')
+        self.con.execute('CREATE TABLE day_summary (sched_day text PRIMARY KEY, n_events integer)')
+        scsc.init_summary_table(self.con)
+
+        summaries = scsc.get_summaries(self.con, datetime.date(2016, 9, 21), datetime.date(2016, 9, 22))
+        self.assertEqual(summaries[0]['category_minutes'], {'varsity': 120, 'rec_swim': 60})
+
+
+class TestPageSource(TestCase):
+
+    """
+    Tests parsing the HTML source of archived pages, with no browser.
+    """
+
+    file_20160921 = os.path.join('test_resources', '20160921_schedule.html')
+
+    # an all-day appointment, as the scheduler shows it in the horizontal appointment layer
+    all_day_appointment = u'''
+    <div id="ctl00_contentMain_schedulerMain_aptsBlock_AptDiv11" class="dxscApt">
+        <div id="ctl00_contentMain_schedulerMain_aptsBlock_AptTemplateContainer100_ctl00_appointmentDiv">
+            <table><tbody><tr><td>
+                <img src="/DXR.axd?r=1_36-sXAfc" alt="Recurrence">
+                <span id="ctl00_contentMain_schedulerMain_aptsBlock_AptTemplateContainer100_ctl00_lblStartTime">12:00 AM-</span>
+                <span id="ctl00_contentMain_schedulerMain_aptsBlock_AptTemplateContainer100_ctl00_lblEndTime">12:00 AM</span>
+                <span id="ctl00_contentMain_schedulerMain_aptsBlock_AptTemplateContainer100_ctl00_lblTitle"> Pool Closed</span>
+            </td></tr></tbody></table>
+        </div>
+    </div>
+    '''
+
+    def test_parse_events(self):
+        """
+        Parse a page with many events, and make sure the results match those checked in TestArchivedPages.
+        """
+
+        with codecs.open(self.file_20160921, 'r', 'utf-8') as fd:
+            events = scsc.parse_events(fd.read())
+
+        self.assertEqual(len(events), 11)
+        self.assertEqual(events[4], (
+            2016, 9, 21, '2016-09-21 13:00:00', '2016-09-21 15:00:00', 'Subject: Varsity Swimming'
+        ))
+        self.assertEqual(events[5][5], 'Course: Fall 2016 - Fitness Swimmer - Co-ed - 10 classes - Fit Swim - Wed')
+
+    def test_parse_events_all_day(self):
+        """
+        Make sure that all-day appointments are left out, like get_events does.
+        """
+
+        with codecs.open(self.file_20160921, 'r', 'utf-8') as fd:
+            page_source = fd.read()
+        expected = scsc.parse_events(page_source)
+
+        layer = u'<div id="ctl00_contentMain_schedulerMain_containerBlock_horizontalContainerappointmentLayer" ' \
+                u'style="height: 0px;">'
+        self.assertEqual(page_source.count(layer), 1)
+        page_source = page_source.replace(layer, layer + self.all_day_appointment)
+
+        self.assertEqual(scsc.parse_events(page_source), expected)
+
+
+class TestBrowserProfile(TestCase):
+
+    def test_wildcard_to_regex(self):
+        """
+        Test that URL patterns for the lean browser profile match the intended resources.
+        """
+
+        css = re.compile(scsc.wildcard_to_regex('*.css?*'))
+        self.assertTrue(css.match('https://nike.uwaterloo.ca/site.css?v=2'))
+        self.assertFalse(css.match('https://nike.uwaterloo.ca/DXR.axd?r=1_32-sXAfc'))
+
+        scripts = re.compile(scsc.wildcard_to_regex('*/Scripts/*'))
+        self.assertTrue(scripts.match('https://nike.uwaterloo.ca/Scripts/Utilities.js'))
+        self.assertFalse(scripts.match('https://nike.uwaterloo.ca/ScriptResource.axd?d=abc'))
+
+    def test_lean_profile_keeps_scripts(self):
+        """
+        Make sure the lean browser profile doesn't block any of the scripts the schedule page loads.
+        """
+
+        with codecs.open(os.path.join('test_resources', '20160921_schedule.html'), 'r', 'utf-8') as fd:
+            page_source = fd.read()
+        script_urls = re.findall(r'<script[^>]*\ssrc="([^"]+)"', page_source)
+        self.assertGreater(len(script_urls), 0)
+
+        blocked = [re.compile(scsc.wildcard_to_regex(pattern), re.IGNORECASE) for pattern in scsc.lean_blocked_urls]
+        for url in script_urls:
+            url = urlparse.urljoin('https://nike.uwaterloo.ca/FacilityScheduling/', url.replace('&amp;', '&'))
+            self.assertFalse(any(regex.match(url) for regex in blocked), '%s is blocked' % url)
+
+
+class TestRateLimiter(TestCase):
+
+    def test_pacing(self):
+        """
+        Test that requests beyond the burst size are spaced out according to the rate.
+        """
+
+        limiter = rate_limiter.RateLimiter(rate=20., burst=1)
+
+        start = time.time()
+        for _ in range(5):
+            with limiter.request():
+                pass
+        elapsed = time.time() - start
+
+        # first request is free, the other four wait 1/20 s each
+        self.assertGreaterEqual(elapsed, 0.19)
+
+    def test_circuit_breaker(self):
+        """
+        Test that the circuit opens after repeated failures, and closes again after a successful probe.
+        """
+
+        now = [0.]
+        limiter = rate_limiter.RateLimiter(rate=1000., burst=10, min_samples=3, cooldown=60., clock=lambda: now[0])
+
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0.1, failed=True)
+        self.assertEqual(limiter.state, rate_limiter.OPEN)
+        self.assertEqual(limiter.open_until, 60.)
+
+        # a failed probe after the cooldown doubles the cooldown
+        now[0] = 61.
+        is_probe = limiter.acquire()
+        self.assertTrue(is_probe)
+        self.assertEqual(limiter.state, rate_limiter.HALF_OPEN)
+        limiter.release(0.1, failed=True, is_probe=is_probe)
+        self.assertEqual(limiter.state, rate_limiter.OPEN)
+        self.assertEqual(limiter.open_until, 61. + 120.)
+
+        # a successful probe closes the circuit
+        now[0] = 200.
+        is_probe = limiter.acquire()
+        limiter.release(0.1, is_probe=is_probe)
+        self.assertEqual(limiter.state, rate_limiter.CLOSED)
+        self.assertEqual(limiter.cooldown, 60.)
+
+    def test_circuit_breaker_stale_release(self):
+        """
+        Test that a request already in flight when the circuit opened can't decide the probe's outcome.
+        """
+
+        now = [0.]
+        limiter = rate_limiter.RateLimiter(rate=1000., burst=10, max_concurrency=2, min_samples=3, cooldown=60.,
+                                           clock=lambda: now[0])
+
+        slow_request = limiter.acquire()
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0.1, failed=True)
+        self.assertEqual(limiter.state, rate_limiter.OPEN)
+
+        now[0] = 61.
+        is_probe = limiter.acquire()
+
+        # the slow request finishing, successfully or not, leaves the probe in charge
+        limiter.release(61., is_probe=slow_request)
+        self.assertEqual(limiter.state, rate_limiter.HALF_OPEN)
+
+        limiter.release(0.1, is_probe=is_probe)
+        self.assertEqual(limiter.state, rate_limiter.CLOSED)
+
+    def test_request_frees_slot(self):
+        """
+        Test that request() frees its slot even when the block is left by a BaseException.
+        """
+
+        limiter = rate_limiter.RateLimiter(rate=1000., burst=10)
+
+        def interrupted():
+            with limiter.request():
+                raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, interrupted)
+        self.assertEqual(limiter._active, 0)
+
+    def test_circuit_breaker_latency(self):
+        """
+        Test that the circuit opens when requests become slow, even if they succeed.
+        """
+
+        limiter = rate_limiter.RateLimiter(rate=1000., burst=10, min_samples=3, latency_threshold=5.)
+
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(10.)
+        self.assertEqual(limiter.state, rate_limiter.OPEN)
+
 
 class TestArchivedPages(TestCase):
 
@@ -57,13 +550,16 @@ class TestArchivedPages(TestCase):
     file_20160921 = os.path.join('test_resources', '20160921_schedule.html')
     file_20170902 = os.path.join('test_resources', '20170902_schedule.html')
 
+    # whether to use the lean browser profile
+    lean = False
+
     @classmethod
     def setUpClass(cls):
-        scsc.init_browser()
+        scsc.init_browser(lean=cls.lean)
 
     @classmethod
     def tearDownClass(cls):
-        scsc.browser.quit()
+        scsc.quit_browser()
 
     def test_get_date(self):
         """
@@ -110,6 +606,15 @@ class TestArchivedPages(TestCase):
         self.assertEqual(ev5[4], end_time)
         self.assertEqual(ev5[5], 'Course: Fall 2016 - Fitness Swimmer - Co-ed - 10 classes - Fit Swim - Wed')
 
+    def test_parse_events(self):
+        """
+        Make sure that parsing the page source gives the same events as scraping the page in the browser.
+        """
+
+        for fn in [self.file_20160921, self.file_20170902]:
+            scsc.nav_to_local_file(fn)
+            self.assertEqual(scsc.parse_events(scsc.browser.page_source), scsc.get_events())
+
     def test_update_day(self):
         """
         Test that schedule info is properly added to the database events and log tables.
@@ -202,6 +707,14 @@ class TestArchivedPages(TestCase):
         self.assertEqual(rows.next(), old_events[2])
 
 
+class TestArchivedPagesLean(TestArchivedPages):
+
+    """
+    Same tests as TestArchivedPages, making sure that pages still parse with the lean browser profile.
+    """
+
+    lean = True
+
 
 class TestLiveSite(TestCase):
 
@@ -217,7 +730,7 @@ class TestLiveSite(TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        scsc.browser.quit()
+        scsc.quit_browser()
 
     def test_nav_to_date_invalid_date(self):
         # plug in an invalid date to see if error is raised